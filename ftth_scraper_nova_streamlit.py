@@ -4,6 +4,9 @@
 import io
 import re
 import time
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import requests
 import pandas as pd
 import streamlit as st
@@ -138,6 +141,97 @@ def _http_get(url, *, headers, params=None, timeout=TIMEOUT, max_retries=3):
     raise RuntimeError(last_err or "Αποτυχία κλήσης")
 
 
+GEO_PROVIDERS = {
+    "cache": {"label": "Cache", "paid": False, "latency": 0.0},
+    "nominatim": {"label": "Nominatim", "paid": False, "latency": 0.5},
+    "google": {"label": "Google", "paid": True, "latency": 0.3},
+}
+GOOGLE_CALL_COST_SEC = 2.0
+GEO_EXPLORE_EVERY = 10
+GEO_BREAKER_ERRORS = 3
+GEO_RATELIMIT_RETRIES = 3
+GEO_MAX_BACKOFF_SEC = 30.0
+COUNTRY_CODE_RX = re.compile(r"^[A-Za-z]{2}$")
+
+
+class GeocodeRateLimited(RuntimeError):
+    pass
+
+
+def _geo_cacheable(response):
+    if "maps.googleapis.com" not in getattr(response, "url", ""):
+        return True
+    try:
+        return response.json().get("status") in ("OK", "ZERO_RESULTS")
+    except Exception:
+        return False
+
+
+class GeocodeRouter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routed = 0
+        self.stats = {
+            p: {"calls": 0, "hits": 0, "errors": 0, "seconds": 0.0, "timed": 0, "first_calls": 0, "first_hits": 0, "error_streak": 0}
+            for p in GEO_PROVIDERS
+        }
+
+    def record(self, provider, outcome, seconds=0.0, cached=False, first_hop=False):
+        with self._lock:
+            s = self.stats[provider]
+            s["calls"] += 1
+            if outcome in ("error", "ratelimit"):
+                s["errors"] += 1
+                s["error_streak"] += int(outcome == "error")
+                return
+            s["error_streak"] = 0
+            hit = outcome == "hit"
+            s["hits"] += int(hit)
+            if not cached:
+                s["seconds"] += seconds
+                s["timed"] += 1
+            if first_hop:
+                s["first_calls"] += 1
+                s["first_hits"] += int(hit)
+
+    def disabled(self, provider):
+        with self._lock:
+            return self.stats[provider]["error_streak"] >= GEO_BREAKER_ERRORS
+
+    def score(self, provider):
+        with self._lock:
+            s = dict(self.stats[provider])
+        success = (s["first_hits"] + 1) / (s["first_calls"] + 2)
+        latency = s["seconds"] / s["timed"] if s["timed"] else GEO_PROVIDERS[provider]["latency"]
+        cost = GOOGLE_CALL_COST_SEC if GEO_PROVIDERS[provider]["paid"] else 0.0
+        return (latency + cost) / success
+
+    def order(self, available):
+        chain = sorted((p for p in available if not self.disabled(p)), key=self.score)
+        with self._lock:
+            self._routed += 1
+            explore = self._routed % GEO_EXPLORE_EVERY == 0
+        if explore and len(chain) > 1:
+            chain[0], chain[1] = chain[1], chain[0]
+        return chain
+
+    def summary(self) -> pd.DataFrame:
+        with self._lock:
+            rows = []
+            for p, s in self.stats.items():
+                answered = s["calls"] - s["errors"]
+                rows.append({
+                    "Provider": GEO_PROVIDERS[p]["label"],
+                    "Κλήσεις": s["calls"],
+                    "Επιτυχίες": s["hits"],
+                    "Σφάλματα": s["errors"],
+                    "Ποσοστό επιτυχίας": round(s["hits"] / answered, 3) if answered else None,
+                    "Μέσος χρόνος (s)": round(s["seconds"] / s["timed"], 3) if s["timed"] else None,
+                    "Απενεργοποιημένος": s["error_streak"] >= GEO_BREAKER_ERRORS,
+                })
+        return pd.DataFrame(rows)
+
+
 @st.cache_data(show_spinner=False, ttl=60 * 30)
 def md_prefectures():
     r = _http_get(f"{_base()}/metadata/prefectures", headers=_hdr())
@@ -450,11 +544,24 @@ with tab_gemi:
 with tab_ftth:
     st.subheader("📡 FTTH Geocoding & Matching")
     with st.expander("⚙️ Ρυθμίσεις γεωκωδικοποίησης & απόστασης", expanded=True):
-        geocoder = st.selectbox("Geocoder", ["Nominatim (δωρεάν)", "Google (API key)"], key="ftth_geocoder")
-        google_key = st.text_input("Google API key", type="password", help="Αν είναι κενό, χρησιμοποιείται Nominatim.", key="ftth_google_key")
+        geocoder = st.selectbox(
+            "Geocoder",
+            ["Αυτόματο (router)", "Nominatim (δωρεάν)", "Google (API key)"],
+            help="Αυτόματο: επιλέγει τον φθηνότερο provider με βάση επιτυχία/χρόνο και οι αποτυχίες περνούν στον επόμενο provider. Nominatim/Google: χρησιμοποιείται μόνο ο επιλεγμένος provider.",
+            key="ftth_geocoder",
+        )
+        google_key = st.text_input("Google API key", type="password", help="Αν είναι κενό, χρησιμοποιείται μόνο Nominatim.", key="ftth_google_key")
         country = st.text_input("Country code", "gr", key="ftth_country")
         lang = st.text_input("Language", "el", key="ftth_lang")
-        throttle = st.slider("Καθυστέρηση (sec) [Nominatim]", 0.5, 2.0, 1.0, 0.5, key="ftth_throttle")
+        throttle = st.slider(
+            "Καθυστέρηση (sec) [μετά από 429]",
+            0.5,
+            2.0,
+            1.0,
+            0.5,
+            help="Αρχική καθυστέρηση ανάμεσα στις κλήσεις ενός provider αφού απαντήσει 429 / όριο κλήσεων. Διπλασιάζεται σε κάθε νέο 429.",
+            key="ftth_throttle",
+        )
         distance_limit = st.number_input("📏 Μέγιστη απόσταση (m)", min_value=1, max_value=500, value=150, key="ftth_distance")
 
     source = st.radio("Πηγή Επιχειρήσεων", ["Upload Excel/CSV", "Από ΓΕΜΗ (τελευταίο αποτέλεσμα δεξιά)"], index=0, horizontal=True)
@@ -513,45 +620,120 @@ with tab_ftth:
     biz_df = load_table(biz_file) if source == "Upload Excel/CSV" and biz_file else (st.session_state.get("last_gemi_df") if source != "Upload Excel/CSV" else None)
 
     if CACHE_OK:
-        requests_cache.install_cache("geocode_cache", backend="sqlite", expire_after=60 * 60 * 24 * 14)
-    session = requests.Session()
-    session.headers.update({"User-Agent": "ftth-app/1.0 (+contact: user)"})
+        requests_cache.install_cache("geocode_cache", backend="sqlite", expire_after=60 * 60 * 24 * 14, filter_fn=_geo_cacheable)
+    geo_local = threading.local()
+
+    def geo_session():
+        if not hasattr(geo_local, "session"):
+            geo_local.session = requests.Session()
+            geo_local.session.headers.update({"User-Agent": "ftth-app/1.0 (+contact: user)"})
+        return geo_local.session
 
     def geocode_nominatim(address, cc="gr", lang="el"):
         params = {"q": address, "format": "json", "limit": 1, "countrycodes": cc, "accept-language": lang}
-        r = session.get("https://nominatim.openstreetmap.org/search", params=params, timeout=15)
+        r = geo_session().get("https://nominatim.openstreetmap.org/search", params=params, timeout=15)
+        cached = bool(getattr(r, "from_cache", False))
+        if r.status_code == 429:
+            raise GeocodeRateLimited("Nominatim: 429 Too Many Requests")
         r.raise_for_status()
         data = r.json()
         if data:
-            return float(data[0]["lat"]), float(data[0]["lon"])
-        return None, None
+            return float(data[0]["lat"]), float(data[0]["lon"]), cached
+        return None, None, cached
 
-    def geocode_google(address, api_key, lang="el"):
+    def geocode_google(address, api_key, cc="gr", lang="el"):
         params = {"address": address, "key": api_key, "language": lang}
-        r = session.get("https://maps.googleapis.com/maps/api/geocode/json", params=params, timeout=15)
+        codes = [c.strip() for c in str(cc).split(",")]
+        if codes and all(COUNTRY_CODE_RX.match(c) for c in codes):
+            params["components"] = "|".join(f"country:{c.upper()}" for c in codes)
+        r = geo_session().get("https://maps.googleapis.com/maps/api/geocode/json", params=params, timeout=15)
+        cached = bool(getattr(r, "from_cache", False))
+        if r.status_code == 429:
+            raise GeocodeRateLimited("Google: 429 Too Many Requests")
         r.raise_for_status()
         js = r.json()
-        if js.get("status") == "OK" and js.get("results"):
+        status = js.get("status")
+        if status == "OK" and js.get("results"):
             loc = js["results"][0]["geometry"]["location"]
-            return float(loc["lat"]), float(loc["lng"])
-        return None, None
-
-    def geocode_address(address, provider, api_key=None, cc="gr", lang="el", throttle_sec=1.0):
-        if provider.startswith("Google") and api_key:
-            lat, lon = geocode_google(address, api_key, lang=lang)
-        else:
-            lat, lon = geocode_nominatim(address, cc, lang)
-            if not getattr(session, "cache_disabled", True):
-                time.sleep(throttle_sec)
-        if (lat is None) and ("greece" not in address.lower()) and ("ελλάδα" not in address.lower()):
-            fallback = f"{address}, Greece"
-            if provider.startswith("Google") and api_key:
-                lat, lon = geocode_google(fallback, api_key, lang=lang)
+            return float(loc["lat"]), float(loc["lng"]), cached
+        if status == "OVER_QUERY_LIMIT":
+            raise GeocodeRateLimited(f"Google: {status}")
+        if status not in ("OK", "ZERO_RESULTS"):
+            raise RuntimeError(f"Google: {status} {js.get('error_message', '')}".strip())
+        return None, None, cached
+
+    def geocode_with(router, gate, provider, address, api_key=None, cc="gr", lang="el", throttle_sec=1.0, first_hop=False):
+        with gate["lock"]:
+            slot = max(time.monotonic(), gate["next"])
+            gate["next"] = slot + gate["interval"]
+        if slot > time.monotonic():
+            time.sleep(slot - time.monotonic())
+        t0 = time.perf_counter()
+        lat = lon = err = None
+        cached = False
+        try:
+            if provider == "google":
+                lat, lon, cached = geocode_google(address, api_key, cc=cc, lang=lang)
             else:
-                lat, lon = geocode_nominatim(fallback, cc, lang)
-                if not getattr(session, "cache_disabled", True):
-                    time.sleep(throttle_sec)
-        return lat, lon
+                lat, lon, cached = geocode_nominatim(address, cc, lang)
+            outcome = "hit" if lat is not None else "miss"
+        except GeocodeRateLimited as e:
+            outcome, err = "ratelimit", str(e)
+        except Exception as e:
+            outcome, err = "error", f"{GEO_PROVIDERS[provider]['label']}: {e}"
+        router.record(provider, outcome, time.perf_counter() - t0, cached=cached, first_hop=first_hop)
+        if outcome == "ratelimit":
+            with gate["lock"]:
+                gate["interval"] = min(GEO_MAX_BACKOFF_SEC, max(throttle_sec, gate["interval"] * 2))
+                gate["next"] = max(gate["next"], time.monotonic() + gate["interval"])
+        return lat, lon, outcome, err
+
+    def geocode_many(router, addresses, available, api_key=None, cc="gr", lang="el", throttle_sec=1.0, on_done=None, max_inflight=8):
+        executors = {"nominatim": ThreadPoolExecutor(max_workers=1), "google": ThreadPoolExecutor(max_workers=4)}
+        gates = {p: {"lock": threading.Lock(), "interval": 0.0, "next": 0.0} for p in executors}
+        results = {}
+        errors = []
+        pending = {}
+        todo = deque(addresses)
+
+        def submit(addr, chain, first_hop=False, retries=0):
+            provider, rest = chain[0], chain[1:]
+            fut = executors[provider].submit(geocode_with, router, gates[provider], provider, addr, api_key, cc, lang, throttle_sec, first_hop)
+            pending[fut] = (addr, provider, rest, retries)
+
+        try:
+            while todo or pending:
+                while todo and len(pending) < max_inflight:
+                    chain = router.order(available)
+                    addr = todo.popleft()
+                    if chain:
+                        submit(addr, chain, first_hop=True)
+                    else:
+                        results[addr] = (None, None, "")
+                        if on_done:
+                            on_done(len(results))
+                if not pending:
+                    continue
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    addr, provider, rest, retries = pending.pop(fut)
+                    lat, lon, outcome, err = fut.result()
+                    if outcome == "ratelimit" and retries < GEO_RATELIMIT_RETRIES:
+                        submit(addr, [provider] + rest, retries=retries + 1)
+                        continue
+                    if err:
+                        errors.append(err)
+                    rest = [p for p in rest if not router.disabled(p)]
+                    if outcome != "hit" and rest:
+                        submit(addr, rest)
+                        continue
+                    results[addr] = (lat, lon, GEO_PROVIDERS[provider]["label"] if outcome == "hit" else "")
+                    if on_done:
+                        on_done(len(results))
+        finally:
+            for ex in executors.values():
+                ex.shutdown(wait=False, cancel_futures=True)
+        return results, errors
 
     start = st.button("🚀 Ξεκίνα geocoding & matching", key="ftth_start")
     if start and biz_df is not None and ftth_df is not None:
@@ -591,23 +773,33 @@ with tab_ftth:
                 for _, r in p.iterrows():
                     geo_map[str(r["Address"]).strip()] = (float(r["Latitude"]), float(r["Longitude"]))
 
-        work["Latitude"] = pd.NA
-        work["Longitude"] = pd.NA
+        addr_key = work["Address"].astype(str).str.strip()
+        found = {a: (lat, lon, "Cache") for a, (lat, lon) in geo_map.items()}
+        to_geocode = [a for a in addr_key.drop_duplicates() if a not in found]
+        unique_total = len(to_geocode)
+        if unique_total == 0:
+            progress.progress(1.0, text=f"{total} / {total} από cache")
 
-        for i, (idx, row) in enumerate(work.iterrows(), start=1):
-            addr = str(row["Address"]).strip()
-            if addr in geo_map:
-                lat, lon = geo_map[addr]
-            else:
-                lat, lon = geocode_address(addr, geocoder, api_key=google_key, cc=country, lang=lang, throttle_sec=throttle)
-                if (lat is not None) and (lon is not None):
-                    geo_map[addr] = (lat, lon)
-                else:
-                    lat, lon = (None, None)
-            work.at[idx, "Latitude"] = lat
-            work.at[idx, "Longitude"] = lon
-            progress.progress(i / max(1, total), text=f"{i} / {total} γεωκωδικοποιημένα…")
+        def _on_geocoded(n):
+            progress.progress(n / max(1, unique_total), text=f"{n} / {unique_total} μοναδικές διευθύνσεις γεωκωδικοποιημένες…")
 
+        if geocoder.startswith("Google") and google_key:
+            available = ["google"]
+        elif geocoder.startswith("Αυτόματο") and google_key:
+            available = ["nominatim", "google"]
+        else:
+            available = ["nominatim"]
+        router = GeocodeRouter()
+        for _ in range(addr_key.nunique() - unique_total):
+            router.record("cache", "hit", cached=True)
+        geo_results, geo_errors = geocode_many(router, to_geocode, available, api_key=google_key, cc=country, lang=lang, throttle_sec=throttle, on_done=_on_geocoded)
+        found.update(geo_results)
+        if geo_errors:
+            st.warning(f"⚠️ {len(geo_errors)} σφάλματα geocoding (π.χ. {geo_errors[0]}). Δες τα στατιστικά providers αυτού του run.")
+
+        work["Latitude"] = addr_key.map(lambda a: found.get(a, (None, None, ""))[0])
+        work["Longitude"] = addr_key.map(lambda a: found.get(a, (None, None, ""))[1])
+        work["Geo_Provider"] = addr_key.map(lambda a: found.get(a, (None, None, ""))[2])
         work["Latitude"] = pd.to_numeric(work["Latitude"], errors="coerce")
         work["Longitude"] = pd.to_numeric(work["Longitude"], errors="coerce")
         merged = work.copy()
@@ -629,12 +821,16 @@ with tab_ftth:
                         "Address": row["Address"],
                         "Latitude": biz_lat,
                         "Longitude": biz_lon,
+                        "Geo_Provider": row.get("Geo_Provider", ""),
                         "FTTH_lat": float(ft_lat),
                         "FTTH_lon": float(ft_lon),
                         "Distance(m)": round(d, 2),
                     })
                     break
 
+        with st.expander("📊 Στατιστικά geocoding providers (αυτό το run)"):
+            st.dataframe(router.summary(), use_container_width=True, hide_index=True)
+
         result_df = pd.DataFrame(matches)
         if not result_df.empty and "Distance(m)" in result_df.columns:
             result_df = result_df.sort_values("Distance(m)").reset_index(drop=True)
@@ -646,7 +842,7 @@ with tab_ftth:
 
         c1, c2, c3 = st.columns(3)
         with c1:
-            st.download_button("⬇️ Geocoded διευθύνσεις", to_excel_bytes(merged[["Address", "Latitude", "Longitude"]], "geocoded"), file_name="geocoded_addresses.xlsx")
+            st.download_button("⬇️ Geocoded διευθύνσεις", to_excel_bytes(merged[["Address", "Latitude", "Longitude", "Geo_Provider"]], "geocoded"), file_name="geocoded_addresses.xlsx")
         with c2:
             st.download_button("⬇️ Αποτελέσματα Matching", to_excel_bytes(result_df, "matching"), file_name="ftth_matching_results.xlsx")
         with c3: